@@ -6,8 +6,15 @@
 
 import os
 import re
+import json
 import time
+import sqlite3
+import threading
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 import streamlit as st
 from dotenv import load_dotenv
@@ -32,9 +39,112 @@ ADZUNA_APP_KEY = _get_secret("ADZUNA_APP_KEY")
 
 USER_AGENT = "Mozilla/5.0 (Manpower Engineering — Controls/Automation Finder)"
 TIMEOUT = 20
+MAX_WORKERS = 4  # concurrent Adzuna requests (all groups x pages share the pool)
+JOB_COLUMNS = ["feed", "company", "title", "location", "posted_at", "url"]
+MAX_QUERY_CHARS = 1200  # cap for a merged OR query (keeps the request URL short)
+ADZUNA_RATE_PER_MIN = 25  # Adzuna default limit: 25 hits/minute per app key
 DEFAULT_COUNTRY = "us"  # Adzuna market
 DEFAULT_CATEGORY = "engineering-jobs"  # can be toggled off
 
+# --------- HTTP session (keep-alive + retries, shared by all calls) ----------
+@st.cache_resource(show_spinner=False)
+def _make_session() -> requests.Session:
+    s = requests.Session()
+    s.headers.update({"User-Agent": USER_AGENT})
+    adapter = HTTPAdapter(
+        pool_connections=MAX_WORKERS,
+        pool_maxsize=MAX_WORKERS * 2,
+        max_retries=Retry(
+            total=2, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+            respect_retry_after_header=True,
+            raise_on_status=False,  # hand back the last 429/5xx so raise_for_status keeps .response
+        ),
+    )
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+SESSION = _make_session()  # cached -> survives Streamlit reruns
+
+# --------- Rate limiting (pace requests instead of eating 429s) ----------
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a request may be sent."""
+
+    def __init__(self, rate_per_sec: float, burst: int):
+        self.rate = rate_per_sec
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+@st.cache_resource(show_spinner=False)
+def _adzuna_bucket() -> TokenBucket:
+    # burst + refill over any 60s window == ADZUNA_RATE_PER_MIN; shared by all sessions
+    burst = ADZUNA_RATE_PER_MIN // 2
+    return TokenBucket((ADZUNA_RATE_PER_MIN - burst) / 60, burst)
+
+# --------- Disk cache (Adzuna responses survive restarts/redeploys) ----------
+CACHE_PATH = os.getenv("ADZUNA_CACHE_PATH", ".adzuna_cache.sqlite")
+CACHE_TTLS = {"short": 300, "normal": 3600, "long": 3 * 3600}  # seconds
+CACHE_RETENTION = 3 * 24 * 3600  # seconds; older rows are pruned (bounds the file, caps stale fallback)
+
+def cache_ttl(max_days_old: int) -> int:
+    """Fresher searches go stale sooner; wide windows barely change hour to hour."""
+    if max_days_old <= 3:
+        return CACHE_TTLS["short"]
+    if max_days_old <= 30:
+        return CACHE_TTLS["normal"]
+    return CACHE_TTLS["long"]
+
+def _cache_conn() -> sqlite3.Connection:
+    # one short-lived connection per call -> safe from worker threads
+    con = sqlite3.connect(CACHE_PATH, timeout=5)
+    con.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, fetched_at REAL, body TEXT)")
+    return con
+
+def _cache_get(key: str, max_age: float) -> tuple[float, dict] | None:
+    """Return (fetched_at, payload) if cached within max_age seconds."""
+    try:
+        with closing(_cache_conn()) as con, con:
+            row = con.execute("SELECT fetched_at, body FROM responses WHERE key = ?", (key,)).fetchone()
+    except sqlite3.Error:
+        return None
+    if not row or time.time() - row[0] > max_age:
+        return None
+    return row[0], json.loads(row[1]) or {}
+
+def _cache_put(key: str, body: str) -> None:
+    try:
+        with closing(_cache_conn()) as con, con:
+            now = time.time()
+            con.execute(
+                "INSERT OR REPLACE INTO responses (key, fetched_at, body) VALUES (?, ?, ?)",
+                (key, now, body),
+            )
+            # every slider/location combo is a new key: drop ones nobody refreshed lately
+            con.execute("DELETE FROM responses WHERE fetched_at < ?", (now - CACHE_RETENTION,))
+    except sqlite3.Error:
+        pass  # cache is best-effort (e.g. read-only filesystem)
+
+def _cache_clear() -> None:
+    try:
+        with closing(_cache_conn()) as con, con:
+            con.execute("DELETE FROM responses")
+    except sqlite3.Error:
+        pass
+
 # --------- Target TERM GROUPS (short lists = safer queries) ----------
 GROUPS = {
     "Core Titles": [
@@ -69,18 +179,26 @@ GROUPS = {
 
 # --------- Minimal sanity filter (keeps scope tight) ----------
 TITLE_KEEP = re.compile(
-    r"(?i)\b("
+    r"(?i)\b(?:"
     r"controls?|automation|robotic|mechatronic|scada|plc|control systems?|process controls?|instrumentation|motion"
     r")\b"
 )
 
-def title_is_relevant(title: str) -> bool:
-    if not title:
-        return False
-    return bool(TITLE_KEEP.search(title))
+# whitespace runs (incl. tabs/newlines in Adzuna text fields)
+WS = re.compile(r"\s+")
+# URL query/fragment (Adzuna tracking params) -- stripped for dedupe keys
+URL_TAIL = re.compile(r"[?#].*$")
+# punctuation/whitespace runs -- collapsed for near-duplicate fingerprints
+NON_ALNUM = re.compile(r"[^a-z0-9]+")
 
 # --------- Adzuna helpers ----------
-def _adzuna_search(country: str, page: int, what: str, where: str, max_days_old: int, use_category: bool):
+def _adzuna_search(country: str, page: int, what: str, where: str, max_days_old: int, use_category: bool, cached: bool = True):
+    # cache key = the query itself (never the credentials)
+    key = json.dumps([country, page, what, where, max_days_old, use_category])
+    if cached:
+        hit = _cache_get(key, cache_ttl(max_days_old))
+        if hit is not None:
+            return hit[1]
     base = f"https://api.adzuna.com/v1/api/jobs/{country}/search/{page}"
     params = {
         "app_id": ADZUNA_APP_ID,
@@ -93,54 +211,195 @@ def _adzuna_search(country: str, page: int, what: str, where: str, max_days_old:
     }
     if use_category:
         params["category"] = DEFAULT_CATEGORY
-    r = requests.get(base, params=params, timeout=TIMEOUT, headers={"User-Agent": USER_AGENT})
-    r.raise_for_status()
-    return (r.json() or {})
-
-def fetch_group(country: str, where: str, max_days_old: int, pages: int, terms: list[str], use_category: bool) -> list[dict]:
-    """Fetch one short OR-query group across N pages."""
-    if not terms:
-        return []
-    # short OR query keeps URL small & avoids truncation
-    query = "(" + " OR ".join([f'"{t}"' for t in terms]) + ")"
+    _adzuna_bucket().acquire()
+    try:
+        r = SESSION.get(base, params=params, timeout=TIMEOUT)
+        r.raise_for_status()
+        data = json.loads(r.content) or {}
+    except (requests.RequestException, ValueError):
+        # stale-while-error: an old page beats no page during an outage/quota hit
+        stale = _cache_get(key, CACHE_RETENTION) if cached else None
+        if stale is None:
+            raise
+        fetched_at, data = stale
+        return {**data, "_stale_from": fetched_at}
+    _cache_put(key, r.text)  # raw body: no re-serialization
+    return data
+
+def _or_query(terms: list[str]) -> str:
+    return "(" + " OR ".join([f'"{t}"' for t in terms]) + ")"
+
+def canonical_terms(terms: list[str]) -> list[str]:
+    """Drop terms that contain another term as a whole-word phrase.
+
+    In an OR query "Controls Engineer" already matches everything
+    "Process Controls Engineer" does, so the longer phrase only costs URL length.
+    """
+    norm = {t: " " + " ".join(t.lower().split()) + " " for t in terms}
+    return [
+        t for t in dict.fromkeys(terms)
+        if not any(o != t and norm[o] != norm[t] and norm[o] in norm[t] for o in norm)
+    ]
+
+def query_batches(selected_groups: list[str], merge: bool) -> list[list[str]]:
+    """Term lists to query: one per group, or (merge=True) packed into as few
+    OR-queries as fit MAX_QUERY_CHARS."""
+    if not merge:
+        return [canonical_terms(GROUPS[g]) for g in selected_groups if GROUPS[g]]
+    batches, cur = [], []
+    for t in canonical_terms([t for g in selected_groups for t in GROUPS[g]]):
+        if cur and len(_or_query(cur + [t])) > MAX_QUERY_CHARS:
+            batches.append(cur)
+            cur = []
+        cur.append(t)
+    if cur:
+        batches.append(cur)
+    return batches
+
+def _is_rate_limited(e: Exception) -> bool:
+    resp = getattr(e, "response", None)
+    return resp is not None and resp.status_code == 429
+
+def fetch_pages(country: str, where: str, max_days_old: int, pages: int, batches: list[list[str]], use_category: bool) -> tuple[dict, set]:
+    """Fetch every (batch, page) pair concurrently on the shared session.
+
+    Returns ({(batch_index, page): payload or the raised exception}, {pages never sent}).
+    """
+    tasks = [(i, p) for i in range(len(batches)) for p in range(1, pages + 1)]
+    fetched, skipped = {}, set()
+    if not tasks:
+        return fetched, skipped
+    # pages and groups are independent HTTP round-trips -> overlap them all
+    with ThreadPoolExecutor(max_workers=min(len(tasks), MAX_WORKERS)) as ex:
+        futs = {
+            ex.submit(_adzuna_search, country, p, _or_query(batches[i]), where, max_days_old, use_category): (i, p)
+            for i, p in tasks
+        }
+        for f in as_completed(futs):
+            if f.cancelled():
+                continue
+            i, p = futs[f]
+            try:
+                fetched[(i, p)] = f.result()
+            except Exception as e:
+                fetched[(i, p)] = e
+                # a group stops at its first failed page, so its later pages would be
+                # discarded; on a 429 every request still queued would be rejected too
+                limited = _is_rate_limited(e)
+                for g, (j, q) in futs.items():
+                    if (limited or (j == i and q > p)) and g.cancel():
+                        skipped.add((j, q))
+    return fetched, skipped
+
+def group_rows(terms: list[str], page_data: list) -> tuple[list[tuple], list[str]]:
+    """Rows (JOB_COLUMNS order) for one OR-query group from its pages, in page order,
+    plus warnings for stale or failed pages.
+
+    page_data holds payloads, exceptions, or None for pages never requested.
+    """
+    warnings = []
+    stale = [d["_stale_from"] for d in page_data if isinstance(d, dict) and "_stale_from" in d]
+    if stale:
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(min(stale)))
+        warnings.append(f"Adzuna unavailable (group='{terms[0]}…'); showing cached results from {when}.")
     out = []
-    for p in range(1, pages + 1):
-        try:
-            data = _adzuna_search(country, p, query, where, max_days_old, use_category)
-        except Exception as e:
-            st.warning(f"Adzuna error (group='{terms[0]}…', page={p}): {e}")
+    for p, data in enumerate(page_data, start=1):
+        # stop at the first failed or unsent page (same as the old serial loop)
+        if isinstance(data, Exception):
+            warnings.append(f"Adzuna error (group='{terms[0]}…', page={p}): {data}")
+            break
+        if data is None:  # cancelled after an earlier failure (see fetch_pages)
             break
         results = data.get("results") or []
         for j in results:
             loc = j.get("location") or {}
-            out.append({
-                "feed": "adzuna",
-                "company": ((j.get("company") or {}).get("display_name") or "")[:200],
-                "title": (j.get("title") or "")[:300],
-                "location": (loc.get("display_name") or "")[:200],
-                "posted_at": j.get("created") or "",
-                "url": j.get("redirect_url") or "",
-                "description": (j.get("description") or "")[:2000],
-            })
-        # be polite
-        time.sleep(0.15)
-    return out
-
-def fetch_all_selected(country: str, where: str, max_days_old: int, pages: int, selected_groups: list[str], use_category: bool) -> pd.DataFrame:
+            out.append((
+                "adzuna",
+                ((j.get("company") or {}).get("display_name") or "")[:200],
+                (j.get("title") or "")[:300],
+                (loc.get("display_name") or "")[:200],
+                j.get("created") or "",
+                j.get("redirect_url") or "",
+            ))
+    return out, warnings
+
+def fetch_all_selected(country: str, where: str, max_days_old: int, pages: int, selected_groups: list[str], use_category: bool, merge: bool = False) -> tuple[pd.DataFrame, list[str]]:
+    """Raw rows for every selected group, plus warnings for stale, failed or unsent pages."""
     if not (ADZUNA_APP_ID and ADZUNA_APP_KEY):
-        return pd.DataFrame()
-    rows = []
-    for gname in selected_groups:
-        rows.extend(fetch_group(country, where, max_days_old, pages, GROUPS[gname], use_category))
-    df = pd.DataFrame(rows)
+        # a warning, so build_results never memoizes the empty frame past a secrets fix
+        return pd.DataFrame(), ["Missing ADZUNA_APP_ID / ADZUNA_APP_KEY; nothing was fetched."]
+    batches = query_batches(selected_groups, merge)
+    fetched, skipped = fetch_pages(country, where, max_days_old, pages, batches, use_category)
+    rows, warnings = [], []
+    for i, terms in enumerate(batches):
+        group, notes = group_rows(terms, [fetched.get((i, p)) for p in range(1, pages + 1)])
+        rows.extend(group)
+        warnings.extend(notes)
+    if skipped:
+        warnings.append(f"{len(skipped)} Adzuna page request(s) not sent after earlier errors.")
+    df = pd.DataFrame.from_records(rows, columns=JOB_COLUMNS)
     if df.empty:
-        return df
-    # basic clean + dedupe
-    for c in ["company", "title", "location", "posted_at", "url"]:
-        if c in df.columns:
-            df[c] = df[c].fillna("").astype(str).str.strip()
-    df = df.drop_duplicates(subset=["title", "company", "location", "url"], keep="first")
-    return df
+        return df, warnings
+    # basic clean (vectorized, once per column; rows are already str)
+    for c in ["company", "title", "location"]:
+        df[c] = df[c].str.replace(WS, " ", regex=True).str.strip()
+    for c in ["posted_at", "url"]:
+        df[c] = df[c].str.strip()
+    return df, warnings
+
+def dedupe(df: pd.DataFrame) -> pd.DataFrame:
+    """Drop repeat postings (across groups/pages) on hashed canonical keys."""
+    # normalized company|title|location, lowercased once and reused by both passes
+    fp = (df["company"] + "|" + df["title"] + "|" + df["location"]).str.lower()
+    fp = fp.str.replace(NON_ALNUM, " ", regex=True).str.strip()
+    # one hashed key per posting: URL minus query/fragment (tracking params vary
+    # between groups), falling back to the fingerprint when URL is blank
+    key = df["url"].str.lower().str.replace(URL_TAIL, "", regex=True)
+    key = key.mask(key.eq(""), fp)
+    keep = ~pd.util.hash_pandas_object(key, index=False).duplicated(keep="first")
+    # near-duplicates: same ad re-listed under a new ad id -> same fingerprint
+    # (64-bit hash, not the strings). Only rows with both company and location
+    # qualify: without them a shared title alone would merge unrelated ads.
+    sure = keep & df["company"].ne("") & df["location"].ne("")
+    near = pd.util.hash_pandas_object(fp[sure], index=False).duplicated(keep="first")
+    return df[keep & ~near.reindex(df.index, fill_value=False)]
+
+class IncompleteSearch(Exception):
+    """Raised by build_results when pages failed or were served stale, so the
+    partial result is never memoized; carries it for display."""
+
+    def __init__(self, raw: pd.DataFrame, df: pd.DataFrame, warnings: list[str]):
+        super().__init__("; ".join(warnings))
+        self.raw, self.df, self.warnings = raw, df, warnings
+
+def _build_results(country: str, where: str, max_days_old: int, pages: int, groups: tuple[str, ...], use_category: bool, merge: bool) -> tuple[pd.DataFrame, pd.DataFrame, list[str]]:
+    raw, warnings = fetch_all_selected(country, where, max_days_old, pages, list(groups), use_category, merge)
+    if raw.empty:
+        return raw, raw, warnings
+    # Relevance first (cheapest, drops the most): keep likely Controls/Automation
+    # titles (light touch), so dedup/dtype/date work only sees relevant rows
+    df = dedupe(raw[raw["title"].str.contains(TITLE_KEEP, na=False)])
+    # low-cardinality columns -> int codes (after dedup: its keys need str ops)
+    df = df.astype({"feed": "category", "company": "category", "location": "category"})
+
+    # Recency & sort
+    df["posted_at"] = pd.to_datetime(df["posted_at"], errors="coerce", utc=True)
+    now_ts = pd.Timestamp.utcnow()
+    df.loc[df["posted_at"].isna(), "posted_at"] = now_ts
+    df = df.sort_values("posted_at", ascending=False, na_position="last")
+    return raw, df, warnings
+
+# no longer than the shortest disk TTL, so fresh (<= 3 day) searches see new pages on time
+@st.cache_data(ttl=min(CACHE_TTLS.values()), show_spinner="Fetching jobs from Adzuna…")
+def build_results(country: str, where: str, max_days_old: int, pages: int, groups: tuple[str, ...], use_category: bool, merge: bool) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """(raw, relevant) frames for one search; cached so repeat fetches skip HTTP + pandas work.
+
+    Raises IncompleteSearch instead of returning when any page failed or was stale.
+    """
+    raw, df, warnings = _build_results(country, where, max_days_old, pages, groups, use_category, merge)
+    if warnings:
+        raise IncompleteSearch(raw, df, warnings)
+    return raw, df
 
 # --------- Sidebar ----------
 with st.sidebar:
@@ -166,16 +425,24 @@ with st.sidebar:
         options=list(GROUPS.keys()),
         default=default_groups,
     )
-
-    st.divider()
-    st.header("Display")
-    top_n = st.slider("Show newest N", 10, 500, 150, step=10)
+    merge_groups = st.checkbox(
+        "Merge groups into fewer queries (fewer API calls, fewer total results)", value=False
+    )
+    batches = query_batches(selected_groups, merge_groups)
+    est_calls = len(batches) * pages
+    st.caption(
+        f"Estimated Adzuna calls per fetch: {est_calls} "
+        f"(paced to {ADZUNA_RATE_PER_MIN}/min; cached pages are free)"
+    )
+    with st.expander("Queries actually dispatched"):
+        for terms in batches:
+            st.code(_or_query(terms), language=None)
 
     st.divider()
     st.header("Diagnostics")
     if st.button("Adzuna smoke test (1 page: 'Controls Engineer')"):
         try:
-            data = _adzuna_search(country, 1, '"Controls Engineer"', where, 45, use_category=True)
+            data = _adzuna_search(country, 1, '"Controls Engineer"', where, 45, use_category=True, cached=False)
             count = len((data or {}).get("results") or [])
             st.write("HTTP OK. Rows:", count)
             if count:
@@ -192,38 +459,52 @@ with st.sidebar:
         except Exception as e:
             st.error(f"Smoke test failed: {e}")
 
+    if st.button("Clear cached results", help="Drop cached Adzuna pages and searches; the next fetch hits the API."):
+        _cache_clear()
+        build_results.clear()
+        st.success("Cache cleared.")
+
     run = st.button("Fetch Jobs")
 
+# --------- Results (fragment: display widgets rerun only this block) ----------
+@st.fragment
+def render_results(df: pd.DataFrame, max_days_old: int) -> None:
+    top_n = st.slider("Show newest N", 10, 500, 150, step=10)
+    st.subheader(f"Newest {min(top_n, len(df))} roles (last {max_days_old} days)")
+    view_cols = [c for c in ["company","title","location","posted_at","url"] if c in df.columns]
+    st.dataframe(df[view_cols].head(top_n), use_container_width=True, hide_index=True)
+
+    st.download_button(
+        "Download CSV",
+        df[view_cols].head(top_n).to_csv(index=False).encode("utf-8"),
+        file_name="controls_automation_adzuna.csv",
+        mime="text/csv",
+    )
+
 # --------- Run search ----------
+# fetch only on click and keep the computed frames, so later reruns (any widget
+# change) redraw the last search without touching the API or build_results
 if run:
-    df = fetch_all_selected(country, where, max_days_old, pages, selected_groups, use_category)
+    try:
+        raw, df = build_results(country, where, max_days_old, pages, tuple(selected_groups), use_category, merge_groups)
+        warnings = []
+    except IncompleteSearch as e:  # shown, but not cached: the next fetch retries
+        raw, df, warnings = e.raw, e.df, e.warnings
+    st.session_state["results"] = (raw, df, warnings, max_days_old)
+
+if "results" in st.session_state:
+    raw, df, warnings, shown_days = st.session_state["results"]
+    for w in warnings:
+        st.warning(w)
 
     # raw debug
     with st.expander("Raw inbound (before relevance filter)"):
-        st.metric("Rows fetched", 0 if df.empty else int(df.shape[0]))
-        if not df.empty:
-            if "posted_at" in df.columns:
-                st.write(df[["company","title","location","posted_at","url"]].head(30))
+        st.metric("Rows fetched", 0 if raw.empty else int(raw.shape[0]))
+        if not raw.empty:
+            if "posted_at" in raw.columns:
+                st.write(raw[["company","title","location","posted_at","url"]].head(30))
         else:
             st.info("No rows from Adzuna. Try: increase 'Max days old', increase 'Pages', or uncheck category.")
 
-    if not df.empty:
-        # Relevance: keep likely Controls/Automation titles (light touch)
-        df = df[df["title"].apply(title_is_relevant)]
-
-        # Recency & sort
-        df["posted_at"] = pd.to_datetime(df["posted_at"], errors="coerce", utc=True)
-        now_ts = pd.Timestamp.utcnow()
-        df.loc[df["posted_at"].isna(), "posted_at"] = now_ts
-        df = df.sort_values("posted_at", ascending=False, na_position="last")
-
-        # Display
-        st.subheader(f"Newest {min(top_n, len(df))} roles (last {max_days_old} days)")
-        view_cols = [c for c in ["company","title","location","posted_at","url"] if c in df.columns]
-        st.dataframe(df[view_cols].head(top_n), use_container_width=True, hide_index=True)
-
-        st.download_button(
-            "Download CSV",
-            df[view_cols].head(top_n).to_csv(index=False).encode("utf-8"),
-            file_name="controls_automation_adzuna.csv",
-            mime="text/csv",
+    if not raw.empty:
+        render_results(df, max_days_old=shown_days)